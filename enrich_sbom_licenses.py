@@ -10,17 +10,29 @@ Stable SBOM License Enricher with Normalization:
 - Normalizes license strings (e.g., 'SEE LICENSE', dict types) to clean SPDX IDs
 """
 
-import json, csv, os, requests, re, fnmatch
+import json, csv, os, requests, re, fnmatch, sqlite3, threading, time, argparse, random, ijson, orjson, gzip, queue
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from packageurl import PackageURL
+from license_expression import get_spdx_licensing
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import nullcontext
+from urllib.parse import urlsplit
 
 # ---------------- CONFIG ----------------
 INPUT_FILE = "sbom-cyclonedx.json"
 OUTPUT_CSV = "sbom-license-enriched.csv"
 OUTPUT_JSON = "sbom-cyclonedx-enriched.json"
 OVERRIDES_FILE = "license_overrides.json"
-MAX_WORKERS = 10
+MAX_WORKERS = 32  # lookups are network-bound, threads mostly wait on I/O
+MAX_RATE_LIMIT_WAIT = 60  # seconds; longer Retry-After / X-RateLimit-Reset waits skip the host instead
+CACHE_FILE = ".license_cache.sqlite"
+CACHE_TTL_HIT = 30 * 86400  # seconds; licenses rarely change upstream
+CACHE_TTL_MISS = 1 * 86400  # seconds; UNKNOWNs are retried sooner in case metadata appears
+NPM_BULK_URL = "https://replicate.npmjs.com/registry/_all_docs"
+NPM_BULK_CHUNK = 100  # package names per bulk request
+CACHE_SCHEMA_VERSION = 4  # bump when lookup logic changes to invalidate old entries
 # -----------------------------------------
 
 # Load GitHub token
@@ -34,6 +46,44 @@ headers = {
 if GITHUB_TOKEN:
     headers["Authorization"] = f"token {GITHUB_TOKEN}"
 
+# Shared HTTP session: keeps TLS connections alive between lookups to the same host.
+# GitHub auth headers are passed per call so the token is never sent to npm/pkg.go.dev.
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = headers["User-Agent"]
+adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        # 429s are left to http_request, which caps its wait at MAX_RATE_LIMIT_WAIT;
+        # Retry-After is ignored here so urllib3 can't sleep for hours holding a host slot
+        status_forcelist=(500, 502, 503, 504),
+        respect_retry_after_header=False,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},  # the npm _all_docs POST is a read
+        raise_on_status=False
+    )
+)
+SESSION.mount("https://", adapter)
+
+# Per-host concurrency limits so one strict registry can't be flooded by every worker
+HOST_SEMAPHORES = {
+    "api.github.com": threading.Semaphore(8),
+    "registry.npmjs.org": threading.Semaphore(4),
+    "replicate.npmjs.com": threading.Semaphore(4),
+    "pkg.go.dev": threading.Semaphore(4)
+}
+
+# Host -> epoch until which its rate limit is exhausted (reset beyond MAX_RATE_LIMIT_WAIT)
+host_blocked_until = {}
+
+class RateLimited(requests.RequestException):
+    """Raised instead of calling a host whose rate limit is exhausted until a later reset"""
+
+# Per-thread flag set when a lookup hit a transport error, rate limit or non-definitive
+# status, so its UNKNOWN is not negative-cached on disk
+lookup_status = threading.local()
+
 # Go vanity mapping
 VANITY_MAPPINGS = {
     "golang.org/x/": "github.com/golang/",
@@ -41,9 +91,101 @@ VANITY_MAPPINGS = {
     "go.etcd.io/": "github.com/etcd-io/"
 }
 
+# Internal/replaced module markers for is_internal
+INTERNAL_EXACT = {"", "go.mod"}
+INTERNAL_SUFFIXES = (".go.mod", "requirements.txt", "package-lock.json", "bun.lock")
+INTERNAL_SUBSTRINGS = ("modules/", "vendor/")  # add e.g. "company" for in-house packages
+
+# SPDX expression parser/renderer for normalize_license
+LICENSING = get_spdx_licensing()
+# Build the tokenizer now: it is created lazily and not thread-safe, so concurrent
+# first calls from pool workers could see a half-built one
+LICENSING.parse("MIT")
+
+# Lowercase -> canonical IDs for strings the SPDX parser rejects
+LICENSE_MAP = {
+    "unlicense": "Unlicense",
+    "mit": "MIT",
+    "apache-2.0": "Apache-2.0",
+    "bsd-3-clause": "BSD-3-Clause",
+    "bsd-2-clause": "BSD-2-Clause",
+    "mpl-2.0": "MPL-2.0",
+    "gpl-3.0": "GPL-3.0",
+    "lgpl-3.0": "LGPL-3.0"
+}
+
+# SPDX IDs recognised when scraping pkg.go.dev. Bounded on both sides (raw HTML contains
+# "submit", "commit", ...), and GPL variants keep their -only/-or-later/+ suffix so
+# "LGPL-3.0-or-later" isn't truncated to LGPL-3.0 (which renders as LGPL-3.0-only)
+SPDX_RE = re.compile(
+    r"\b(MIT|Apache-2\.0|BSD-3-Clause|BSD-2-Clause|MPL-2\.0|L?GPL-3\.0(?:-only|-or-later|\+)?)(?![\w+-]|\.\w)",
+    re.IGNORECASE
+)
+
+# PURL types of ecosystems we don't query whose names would otherwise hit unrelated npm packages
+UNSUPPORTED_PURL_TYPES = {
+    "pypi", "maven", "gem", "nuget", "cargo", "composer", "conda", "cocoapods",
+    "pub", "hex", "hackage", "cran", "swift", "deb", "rpm", "apk", "alpm"
+}
+
+# Anchor of the license section on pkg.go.dev pages
+PKG_GO_DEV_LICENSE_MARKER = 'data-test-id="UnitHeader-license"'
+
 # Cache for resolved licenses
 cache = {}
 
+# Lookups in progress, so concurrent callers for the same name share one request
+inflight = {}
+inflight_lock = threading.Lock()
+
+# ---------------- Persistent Cache ----------------
+cache_db = None
+cache_db_lock = threading.Lock()
+
+def open_cache_db(path=CACHE_FILE):
+    """Open (or create) the on-disk license cache shared across runs"""
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("CREATE TABLE IF NOT EXISTS lic (name TEXT PRIMARY KEY, license TEXT, fetched_at INTEGER, status TEXT NOT NULL DEFAULT 'HIT')")
+    # Caches written before misses were stored only hold hits
+    if "status" not in [col[1] for col in db.execute("PRAGMA table_info(lic)")]:
+        db.execute("ALTER TABLE lic ADD COLUMN status TEXT NOT NULL DEFAULT 'HIT'")
+    # Drop rows no run will read again: older schema versions and expired entries
+    now = int(time.time())
+    prefix = cache_key("")
+    db.execute(
+        "DELETE FROM lic WHERE substr(name, 1, length(?)) != ? OR fetched_at < ? - (CASE status WHEN 'MISS' THEN ? ELSE ? END)",
+        (prefix, prefix, now, CACHE_TTL_MISS, CACHE_TTL_HIT)
+    )
+    db.commit()
+    return db
+
+def cache_key(name):
+    """Version cache keys so a schema bump ignores entries from older runs"""
+    return f"v{CACHE_SCHEMA_VERSION}:{name}"
+
+def load_cached_license(name):
+    """Return a non-expired license (or cached UNKNOWN) from the on-disk cache, or None"""
+    if cache_db is None:
+        return None
+    with cache_db_lock:
+        row = cache_db.execute("SELECT license, fetched_at, status FROM lic WHERE name=?", (cache_key(name),)).fetchone()
+    if row:
+        ttl = CACHE_TTL_MISS if row[2] == "MISS" else CACHE_TTL_HIT
+        if time.time() - row[1] < ttl:
+            return row[0]
+    return None
+
+def store_cached_license(name, license_val):
+    """Persist a lookup result; a definitive UNKNOWN is stored as a MISS with the shorter TTL"""
+    if cache_db is None:
+        return
+    status = "MISS" if license_val == "UNKNOWN" else "HIT"
+    with cache_db_lock:
+        cache_db.execute(
+            "INSERT OR REPLACE INTO lic (name, license, fetched_at, status) VALUES (?, ?, ?, ?)",
+            (cache_key(name), license_val, int(time.time()), status)
+        )
+
 # ---------------- Overrides Loader ----------------
 def load_overrides():
     if os.path.exists(OVERRIDES_FILE):
@@ -51,7 +193,22 @@ def load_overrides():
             return json.load(f)
     return {}
 
+def compile_overrides(overrides):
+    """Combine override globs into one regex; patterns keep file order, so the first match wins"""
+    if not overrides:
+        return None, []
+    pattern = "|".join(f"(?P<override{i}>{fnmatch.translate(p)})" for i, p in enumerate(overrides))
+    return re.compile(pattern), list(overrides.values())
+
 overrides = load_overrides()
+override_re, override_licenses = compile_overrides(overrides)
+
+def match_override(name):
+    """Return the override license for name, or None"""
+    if override_re is None:
+        return None
+    m = override_re.match(name)
+    return override_licenses[int(m.lastgroup[len("override"):])] if m else None
 
 # ---------------- License Normalization ----------------
 def normalize_license(license_str):
@@ -59,7 +216,7 @@ def normalize_license(license_str):
     Normalize license strings:
     - Handle dicts from npm ({"type": "MIT", "url": "..."}).
     - Convert 'SEE LICENSE' to UNKNOWN.
-    - Fix lowercase variants (e.g., 'mit' → 'MIT').
+    - Canonicalize SPDX IDs and expressions (e.g., 'mit' → 'MIT', 'MIT or apache-2.0' → 'MIT OR Apache-2.0').
     """
     if not license_str:
         return "UNKNOWN"
@@ -75,34 +232,68 @@ def normalize_license(license_str):
     if "SEE LICENSE" in license_str.upper():
         return "UNKNOWN"
 
-    # Normalize case for known SPDX
-    mapping = {
-        "unlicense": "Unlicense",
-        "mit": "MIT",
-        "apache-2.0": "Apache-2.0",
-        "bsd-3-clause": "BSD-3-Clause",
-        "bsd-2-clause": "BSD-2-Clause",
-        "mpl-2.0": "MPL-2.0",
-        "gpl-3.0": "GPL-3.0",
-        "lgpl-3.0": "LGPL-3.0"
-    }
-    return mapping.get(license_str.lower(), license_str)
+    # Canonical SPDX rendering (IDs, casing, AND/OR/WITH expressions)
+    try:
+        parsed = LICENSING.parse(license_str, validate=True, strict=False)
+    except Exception:
+        # ExpressionError for unknown IDs; malformed input like "()" raises IndexError/AssertionError
+        parsed = None
+    if parsed is not None:
+        return parsed.render()
+
+    # Non-SPDX strings: normalize case for known IDs, otherwise keep as-is
+    return LICENSE_MAP.get(license_str.lower(), license_str)
 
 # ---------------- Helper Functions ----------------
 def is_internal(pkg_name):
     """Identify internal/modules"""
+    pkg_name = pkg_name.strip()
     return (
-        "modules/" in pkg_name or 
-        "vendor/" in pkg_name or
-        #"company" in pkg_name or
-        pkg_name.strip() == "" or
-        pkg_name.endswith(".go.mod") or
-        pkg_name.endswith("requirements.txt") or
-        pkg_name.endswith("package-lock.json") or
-        pkg_name.endswith("bun.lock") or
-        pkg_name == "go.mod"
+        pkg_name in INTERNAL_EXACT or
+        pkg_name.endswith(INTERNAL_SUFFIXES) or
+        any(sub in pkg_name for sub in INTERNAL_SUBSTRINGS)
     )
 
+def rate_limit_delay(r):
+    """Seconds until a rate-limited response's host accepts requests again, or None if not rate-limited"""
+    if r.status_code == 429:
+        retry_after = r.headers.get("Retry-After", "")
+        delay = int(retry_after) if retry_after.isdigit() else 1
+    elif r.status_code == 403 and r.headers.get("X-RateLimit-Remaining") == "0":
+        reset = r.headers.get("X-RateLimit-Reset", "")
+        delay = int(reset) - time.time() if reset.isdigit() else 1
+    else:
+        return None
+    return max(delay, 0)
+
+def http_request(method, url, **kwargs):
+    """
+    Send a request via SESSION under the host's semaphore.
+    Short rate limits are waited out once; if the reset is further than MAX_RATE_LIMIT_WAIT,
+    the host is skipped (RateLimited) until then so callers fall back immediately.
+    """
+    host = urlsplit(url).hostname
+    if time.time() < host_blocked_until.get(host, 0):
+        raise RateLimited(f"{host} rate limit exhausted")
+
+    with HOST_SEMAPHORES.get(host) or nullcontext():
+        # Re-check: another thread may have blocked the host while this one waited for a slot
+        if time.time() < host_blocked_until.get(host, 0):
+            raise RateLimited(f"{host} rate limit exhausted")
+        r = SESSION.request(method, url, **kwargs)
+        delay = rate_limit_delay(r)
+        if delay is not None and delay > MAX_RATE_LIMIT_WAIT:
+            host_blocked_until[host] = time.time() + delay
+        elif delay is not None:
+            # Sleep while holding the slot so other workers back off from this host too
+            time.sleep(delay + random.uniform(0, 1))
+            r = SESSION.request(method, url, **kwargs)
+
+    # Only 200 and 404 are definitive answers about a package
+    if r.status_code not in (200, 404):
+        lookup_status.failed = True
+    return r
+
 def map_vanity_to_github(pkg_name):
     """Map Go vanity URLs to GitHub repos"""
     for vanity, github_prefix in VANITY_MAPPINGS.items():
@@ -118,151 +309,372 @@ def github_license_lookup(pkg_name):
         if len(parts) >= 3:
             api_url = f"https://api.github.com/repos/{parts[1]}/{parts[2]}"
             try:
-                r = requests.get(api_url, headers=headers, timeout=10)
+                r = http_request("GET", api_url, headers=headers, timeout=10)
                 if r.status_code == 200:
-                    return normalize_license(r.json().get("license", {}).get("spdx_id", "UNKNOWN"))
-            except Exception:
-                pass
+                    return normalize_license((r.json().get("license") or {}).get("spdx_id", "UNKNOWN"))
+            except requests.RequestException:
+                lookup_status.failed = True
     return "UNKNOWN"
 
+def npm_license_from_packument(data):
+    """Extract the license of the latest version from an npm packument"""
+    latest_ver = data.get("dist-tags", {}).get("latest")
+    if latest_ver and latest_ver in data.get("versions", {}):
+        return normalize_license(data["versions"][latest_ver].get("license", "UNKNOWN"))
+    return normalize_license(data.get("license", "UNKNOWN"))
+
 def npm_license_lookup(pkg_name):
     """Query npm registry for license (supports no-dash names)"""
     try:
-        r = requests.get(f"https://registry.npmjs.org/{pkg_name}", timeout=10)
+        r = http_request("GET", f"https://registry.npmjs.org/{pkg_name}", timeout=10)
         if r.status_code == 200:
-            data = r.json()
-            latest_ver = data.get("dist-tags", {}).get("latest")
-            if latest_ver and latest_ver in data.get("versions", {}):
-                return normalize_license(data["versions"][latest_ver].get("license", "UNKNOWN"))
-            return normalize_license(data.get("license", "UNKNOWN"))
-    except Exception:
-        pass
+            return npm_license_from_packument(r.json())
+    except requests.RequestException:
+        lookup_status.failed = True
     return "UNKNOWN"
 
+def npm_bulk_license_lookup(pkg_names):
+    """Fetch many npm packuments per request via CouchDB _all_docs; returns only resolved names"""
+    results = {}
+    for i in range(0, len(pkg_names), NPM_BULK_CHUNK):
+        chunk = pkg_names[i:i + NPM_BULK_CHUNK]
+        try:
+            r = http_request("POST", NPM_BULK_URL, params={"include_docs": "true"}, json={"keys": chunk}, timeout=30)
+            if r.status_code != 200:
+                continue
+            for row in r.json().get("rows", []):
+                doc = row.get("doc")
+                if not doc:
+                    continue
+                lic = npm_license_from_packument(doc)
+                if lic != "UNKNOWN":
+                    results[row["key"]] = lic
+        except requests.RequestException:
+            pass
+    return results
+
 def pkg_go_dev_license_lookup(pkg_name):
     """Scrape pkg.go.dev for license info"""
     try:
         url = f"https://pkg.go.dev/{pkg_name}?tab=licenses"
-        r = requests.get(url, timeout=10)
+        r = http_request("GET", url, timeout=10)
         if r.status_code == 200:
-            soup = BeautifulSoup(r.text, "html.parser")
-            text = soup.get_text()
-            matches = re.findall(
-                r"(MIT|Apache-2\.0|BSD-3-Clause|BSD-2-Clause|MPL-2\.0|GPL-3\.0|LGPL-3\.0)",
-                text, re.IGNORECASE
-            )
-            if matches:
-                return normalize_license(matches[0].upper().replace(" ", "-"))
-    except Exception:
-        pass
+            # Regex the raw HTML, narrowed to the license header when present
+            text = r.text
+            start = text.find(PKG_GO_DEV_LICENSE_MARKER)
+            if start != -1:
+                text = text[start:start + 4000]
+            m = SPDX_RE.search(text)
+            if m:
+                return normalize_license(m.group(1))
+    except requests.RequestException:
+        lookup_status.failed = True
     return "UNKNOWN"
 
-def normalize_from_purl(purl):
-    """Normalize PURL (e.g., pkg:npm/hasown@2.0.2) -> hasown"""
+def parse_purl(purl):
+    """
+    Parse a PURL into (name, source), e.g.:
+    - pkg:npm/%40scope/pkg@1.0 -> ("@scope/pkg", "npm")
+    - pkg:golang/github.com/a/b@v1 -> ("github.com/a/b", "github")
+    - pkg:pypi/requests@2.31 -> ("requests", "unsupported"): an ecosystem whose names clash
+      with npm, so no lookup should be made
+    - pkg:generic/github.com/a/b -> ("github.com/a/b", None): other types use name heuristics
+    (None, None) if the PURL is missing or invalid, so callers fall back to name heuristics.
+    """
+    if not purl:
+        return None, None
     try:
-        purl_body = purl.split("/", 1)[1] if "/" in purl else purl
-        purl_body = purl_body.split("@")[0]
-        return purl_body
-    except Exception:
-        return None
+        p = PackageURL.from_string(purl)
+    except ValueError:
+        return None, None
+
+    name = f"{p.namespace}/{p.name}" if p.namespace else p.name
+    if p.type == "github":
+        return f"github.com/{name}", "github"
+    if p.type == "golang":
+        return name, "github" if lookup_source(name) == "github" else "go"
+    if p.type == "npm":
+        return name, "npm"
+    if p.type in UNSUPPORTED_PURL_TYPES:
+        return name, "unsupported"
+    return name, None
 
 # ---------------- Core Resolution ----------------
-def resolve_license(name):
+def resolve_offline(name):
+    """Resolve from cache, overrides, internal markers or the on-disk cache; None if a lookup is needed"""
     # Check cache
     if name in cache:
         return cache[name]
 
     # 1. Check overrides
-    for pattern, license_val in overrides.items():
-        if fnmatch.fnmatch(name, pattern):
-            cache[name] = license_val
-            return license_val
+    license_val = match_override(name)
+    if license_val is not None:
+        cache[name] = license_val
+        return license_val
 
     # 2. Proprietary
     if is_internal(name):
         cache[name] = "Proprietary"
         return "Proprietary"
 
-    # 3. GitHub / vanity mapping
-    if name.startswith("github.com/") or any(name.startswith(v) for v in VANITY_MAPPINGS.keys()):
-        lic = github_license_lookup(name)
-        if lic != "UNKNOWN":
-            cache[name] = lic
-            return lic
-        lic = pkg_go_dev_license_lookup(name)
-        cache[name] = lic
-        return lic
-
-    # 4. Go modules (pkg.go.dev)
-    if name.startswith(("google.golang.org/", "gopkg.in/", "go.opencensus.io", "go.opentelemetry.io", "cloud.google.com/", "k8s.io/", "sigs.k8s.io/")):
-        lic = pkg_go_dev_license_lookup(name)
+    # 3. Persistent cache from earlier runs
+    lic = load_cached_license(name)
+    if lic is not None:
         cache[name] = lic
-        return lic
+    return lic
 
-    # 5. npm fallback
-    if name:
-        lic = npm_license_lookup(name)
-        cache[name] = lic
+def resolve_license(name, source=None):
+    lic = resolve_offline(name)
+    if lic is not None:
         return lic
 
-    cache[name] = "UNKNOWN"
-    return "UNKNOWN"
+    # Claim the lookup, or wait for the thread that already owns it
+    with inflight_lock:
+        if name in cache:
+            return cache[name]
+        fut = inflight.get(name)
+        owner = fut is None
+        if owner:
+            fut = inflight[name] = Future()
+    if not owner:
+        return fut.result()
 
-# ---------------- Main Enrichment ----------------
-def enrich_sbom(input_file):
-    with open(input_file, "r") as f:
-        sbom = json.load(f)
+    try:
+        # 4. Remote lookups
+        lookup_status.failed = False
+        lic = lookup_license(name, source)
+        # Don't persist an UNKNOWN caused by network errors or rate limits
+        if lic != "UNKNOWN" or not lookup_status.failed:
+            store_cached_license(name, lic)
+        cache[name] = lic
+        fut.set_result(lic)
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with inflight_lock:
+            inflight.pop(name, None)
+    return lic
+
+def resolve_license_safe(name, source=None):
+    """resolve_license for executor.map: an unexpected error yields UNKNOWN instead of aborting the run"""
+    try:
+        return resolve_license(name, source)
+    except Exception:
+        return "UNKNOWN"
 
-    components = sbom.get("components", [])
-    enriched_data = []
+def lookup_source(name):
+    """Pick the remote source for a package name: 'github', 'go', 'npm' or None"""
+    if name.startswith("github.com/") or any(name.startswith(v) for v in VANITY_MAPPINGS.keys()):
+        return "github"
+    if name.startswith(("google.golang.org/", "gopkg.in/", "go.opencensus.io", "go.opentelemetry.io", "cloud.google.com/", "k8s.io/", "sigs.k8s.io/")):
+        return "go"
+    if name:
+        return "npm"
+    return None
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_comp = {}
-        for comp in components:
-            name = comp.get("name", "")
-            future_to_comp[executor.submit(resolve_license, name)] = comp
+def lookup_license(name, source=None):
+    """Query GitHub, pkg.go.dev or npm; source (e.g. from the PURL type) overrides name-based routing"""
+    source = source or lookup_source(name)
 
-        for future in as_completed(future_to_comp):
-            comp = future_to_comp[future]
-            name = comp.get("name", "")
-            version = comp.get("version", "")
-            purl = comp.get("purl", "")
+    # GitHub / vanity mapping, falling back to pkg.go.dev
+    if source == "github":
+        lic = github_license_lookup(name)
+        if lic != "UNKNOWN":
+            return lic
+        return pkg_go_dev_license_lookup(name)
 
-            try:
-                enriched_license = future.result()
-            except Exception:
-                enriched_license = "UNKNOWN"
+    # Go modules (pkg.go.dev)
+    if source == "go":
+        return pkg_go_dev_license_lookup(name)
 
-            # Fallback to PURL
-            if enriched_license == "UNKNOWN" and purl:
-                purl_name = normalize_from_purl(purl)
-                if purl_name:
-                    enriched_license = resolve_license(purl_name)
+    # npm fallback
+    if source == "npm":
+        return npm_license_lookup(name)
 
-            # Write back to JSON if resolved
-            if enriched_license != "UNKNOWN":
-                comp["licenses"] = [{"license": {"id": enriched_license}}]
+    return "UNKNOWN"
 
-            enriched_data.append([name, version, enriched_license])
+def prefetch_npm_licenses(names):
+    """Resolve undecided npm packages in bulk up front; misses fall back to per-package lookups"""
+    for name, lic in npm_bulk_license_lookup(sorted(set(names))).items():
+        store_cached_license(name, lic)
+        cache[name] = lic
 
-    # Save enriched JSON
-    with open(OUTPUT_JSON, "w") as jf:
-        json.dump(sbom, jf, indent=2)
+# ---------------- Main Enrichment ----------------
+def iter_components(f, sbom):
+    """Stream CycloneDX components from f; the other top-level keys are collected into sbom"""
+    root = ijson.ObjectBuilder()
+    item = None
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        if prefix == "components.item" or prefix.startswith("components.item."):
+            if item is None:
+                item = ijson.ObjectBuilder()
+            item.event(event, value)
+            if prefix == "components.item" and event not in ("start_map", "start_array", "map_key"):
+                yield item.value
+                item = None
+        elif prefix == "components":
+            continue
+        else:
+            root.event(event, value)
+            if prefix == "" and event == "map_key" and value == "components":
+                # Placeholder keeps the key's position; the caller re-attaches the components
+                root.event("null", None)
+    sbom.update(root.value)
+
+def write_sbom_json(path, sbom, comp_queue, compress=False):
+    """
+    Stream the enriched SBOM to path, taking components from comp_queue until None.
+    Output is byte-identical to orjson.dumps(sbom, option=OPT_INDENT_2); gzip if compress.
+    """
+    skeleton = dict(sbom, components=[]) if "components" in sbom else sbom
+    head, marker, tail = orjson.dumps(skeleton, option=orjson.OPT_INDENT_2).partition(b'\n  "components": []')
+    with (gzip.open(path, "wb", compresslevel=3) if compress else open(path, "wb")) as jf:
+        jf.write(head)
+        if marker:
+            jf.write(b'\n  "components": [')
+        count = 0
+        while (comp := comp_queue.get()) is not None:
+            if not marker:
+                continue
+            item = orjson.dumps(comp, option=orjson.OPT_INDENT_2).replace(b"\n", b"\n    ")
+            jf.write((b",\n    " if count else b"\n    ") + item)
+            count += 1
+        if marker:
+            jf.write(b"\n  ]" if count else b"]")
+        jf.write(tail)
+
+def enrich_sbom(input_file, compress_json=False):
+    output_json = OUTPUT_JSON + ".gz" if compress_json else OUTPUT_JSON
+    sbom = {}
+    components = []
+
+    def dispatch_names(f, sources, npm_names, lookup_keys, key_to_lic, name_to_lic):
+        """
+        Parse components, yielding each unique lookup key that needs a remote lookup; npm keys
+        are deferred. The key is the name decoded from a supported PURL (e.g. "@scope/pkg" for
+        name "pkg", group "@scope"), otherwise the component name; lookup_keys maps name -> key.
+        """
+        for comp in iter_components(f, sbom):
+            components.append(comp)
+            name = comp.get("name", "")
+            if name in lookup_keys or name in name_to_lic:
+                continue
+            # Cache, overrides and internal checks are cheap: decide inline instead of on the pool
+            lic = resolve_offline(name)
+            if lic is not None:
+                name_to_lic[name] = lic
+                continue
+            # Prefer the PURL type and name over name heuristics to pick the registry
+            purl_name, purl_source = parse_purl(comp.get("purl", ""))
+            if purl_source == "unsupported":
+                # e.g. pypi/maven: a same-named npm package would give the wrong license
+                name_to_lic[name] = "UNKNOWN"
+                continue
+            key, source = (purl_name, purl_source) if purl_source else (name, lookup_source(name))
+            lookup_keys[name] = key
+            if key in sources or key in key_to_lic:
+                continue
+            lic = resolve_offline(key) if key != name else None
+            if lic is not None:
+                key_to_lic[key] = lic
+                continue
+            sources[key] = source
+            if source == "npm":
+                npm_names.append(key)
+            else:
+                yield key
 
-    # Save CSV
-    with open(OUTPUT_CSV, "w", newline="") as cf:
-        writer = csv.writer(cf)
-        writer.writerow(["Package Name", "Version", "License"])
-        writer.writerows(enriched_data)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # executor.map submits while it consumes the generator, so lookups start while
+        # the SBOM is still being parsed. Each unique key is resolved once; npm keys
+        # wait for the bulk prefetch below.
+        sources = {}
+        npm_names = []
+        lookup_keys = {}
+        key_to_lic = {}
+        name_to_lic = {}
+        resolve = lambda key: resolve_license_safe(key, sources[key])
+        with open(input_file, "rb") as f:
+            results = executor.map(resolve, dispatch_names(f, sources, npm_names, lookup_keys, key_to_lic, name_to_lic))
+
+        prefetch_npm_licenses(npm_names)
+        npm_results = executor.map(resolve, npm_names)
+
+        key_to_lic.update(zip((k for k, src in sources.items() if src != "npm"), results))
+        key_to_lic.update(zip(npm_names, npm_results))
+        for name, key in lookup_keys.items():
+            name_to_lic[name] = key_to_lic[key]
+
+        # Serialize the JSON on a worker, overlapping with the PURL fallbacks below,
+        # to a temp file that only replaces the output once the run has succeeded
+        tmp_json = output_json + ".tmp"
+        comp_queue = queue.Queue()
+        json_writer = executor.submit(write_sbom_json, tmp_json, sbom, comp_queue, compress_json)
+
+        total = unknown_count = proprietary_count = 0
+        completed = False
+
+        try:
+            # Stream CSV rows instead of buffering them
+            with open(OUTPUT_CSV, "w", newline="") as cf:
+                writer = csv.writer(cf)
+                writer.writerow(["Package Name", "Version", "License"])
+
+                for comp in components:
+                    name = comp.get("name", "")
+                    version = comp.get("version", "")
+                    purl = comp.get("purl", "")
+
+                    enriched_license = name_to_lic[name]
+
+                    # Fallback to PURL
+                    if enriched_license == "UNKNOWN" and purl:
+                        purl_name, purl_source = parse_purl(purl)
+                        if purl_name and purl_source != "unsupported":
+                            enriched_license = resolve_license(purl_name, purl_source)
+
+                    # Write back to JSON if resolved
+                    if enriched_license != "UNKNOWN":
+                        comp["licenses"] = [{"license": {"id": enriched_license}}]
+
+                    comp_queue.put(comp)
+                    writer.writerow([name, version, enriched_license])
+                    total += 1
+                    if enriched_license == "UNKNOWN":
+                        unknown_count += 1
+                    elif enriched_license == "Proprietary":
+                        proprietary_count += 1
+            completed = True
+        finally:
+            comp_queue.put(None)
+            writer_error = json_writer.exception()
+            if completed and writer_error is None:
+                os.replace(tmp_json, output_json)
+            elif os.path.exists(tmp_json):
+                os.remove(tmp_json)
+        if writer_error is not None:
+            raise writer_error
 
     # Summary
-    total = len(enriched_data)
-    unknown_count = sum(1 for row in enriched_data if row[2] == "UNKNOWN")
-    proprietary_count = sum(1 for row in enriched_data if row[2] == "Proprietary")
     resolved_count = total - unknown_count
 
-    print(f"Enriched SBOM JSON → {OUTPUT_JSON}")
+    print(f"Enriched SBOM JSON → {output_json}")
     print(f"Enriched CSV → {OUTPUT_CSV}")
     print(f"\nSummary: {resolved_count}/{total} resolved, {unknown_count} unknown, {proprietary_count} proprietary")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Enrich a CycloneDX SBOM with license information")
+    parser.add_argument("--no-cache", action="store_true", help=f"ignore and do not update {CACHE_FILE}")
+    parser.add_argument("--gzip", action="store_true", help=f"write {OUTPUT_JSON}.gz instead of {OUTPUT_JSON}")
+    args = parser.parse_args()
+
+    if not args.no_cache:
+        cache_db = open_cache_db()
+    try:
+        enrich_sbom(INPUT_FILE, compress_json=args.gzip)
+    finally:
+        SESSION.close()
+        if cache_db is not None:
+            cache_db.commit()
+            cache_db.close()